@@ -1,10 +1,250 @@
 #!/usr/bin/env python3
-import sys, string, os
+import functools, mmap, re, sys, string, os
+from concurrent.futures import ThreadPoolExecutor
 
 DIGITS = string.digits
 WORD = DIGITS + string.ascii_letters + "_"
 
 
+def _translate(p, dollar="$"):
+    """Rewrite our pattern dialect into standard `re` syntax.
+
+    The dialect is almost a subset of `re`, but treats some of re's
+    metacharacters (`*`, `{`, `}`, mid-pattern `^`/`$`, a `+`/`?` right
+    after a quantifier or backref) as literals, allows `[^]` as "any
+    character", escapes arbitrary characters with `\\`, and numbers
+    backref groups per top-level alternative rather than globally.
+    `dollar` is what an end anchor becomes: the dialect's `$` means end
+    of string, so single-string matching passes `\\Z`; the default `$`
+    is for the MULTILINE whole-buffer scans, where it must keep matching
+    at each line end.
+    """
+    out = []
+    i, n = 0, len(p)
+    depth = 0
+    gcount = 0  # capturing groups opened so far
+    gbase = 0  # groups opened before the current top-level alternative
+    after_bar = False  # previous char was an unescaped top-level '|'
+    quant_done = False  # a following +/? is a literal, not a quantifier
+    while i < n:
+        c = p[i]
+        if c == "\\" and i + 1 < n:
+            t = p[i + 1]
+            if t.isdigit():
+                j = i + 2
+                while j < n and p[j].isdigit():
+                    j += 1
+                # Shift the per-alternative group number to re's global
+                # numbering; backrefs take no quantifier in the dialect.
+                out.append("\\" + str(int(p[i + 1 : j]) + gbase))
+                i = j
+                quant_done = True
+            else:
+                out.append(p[i : i + 2] if t in "dw" else re.escape(t))
+                i += 2
+                quant_done = False
+            after_bar = False
+            continue
+        if c == "[":
+            if p.startswith("[^]", i):
+                out.append(r"[\s\S]")
+                i += 3
+            else:
+                neg = p.startswith("[^", i)
+                j = p.index("]", i + (2 if neg else 1))
+                members = p[i + (2 if neg else 1) : j]
+                out.append("[^" if neg else "[")
+                out.append(
+                    "".join("-" if ch == "-" else re.escape(ch) for ch in members)
+                )
+                out.append("]")
+                i = j + 1
+            after_bar = False
+            quant_done = False
+            continue
+        if c in "*{}":
+            out.append(re.escape(c))
+            quant_done = False
+        elif c in "?+":
+            # A quantifier cannot itself be quantified: the second of
+            # `a+?`/`a++` is a literal, not re's lazy/possessive form.
+            out.append("\\" + c if quant_done else c)
+            quant_done = not quant_done
+        elif c == "^" and not (i == 0 or after_bar):
+            out.append(r"\^")
+            quant_done = False
+        elif c == "$" and (i == n - 1 or (depth == 0 and p[i + 1] == "|")):
+            out.append(dollar)
+            quant_done = False
+        elif c == "$":
+            out.append(r"\$")
+            quant_done = False
+        else:
+            if c == "(":
+                depth += 1
+                gcount += 1
+            elif c == ")":
+                depth -= 1
+            out.append(c)
+            quant_done = False
+        if c == "|" and depth == 0:
+            after_bar = True
+            gbase = gcount
+        else:
+            after_bar = False
+        i += 1
+    return "".join(out)
+
+
+@functools.lru_cache(maxsize=256)
+def _compile(p):
+    return re.compile(_translate(p, r"\Z"))
+
+
+@functools.lru_cache(maxsize=256)
+def _literal_prefix(p):
+    """Longest required leading literal of `p`, plus whether it is ^-anchored.
+
+    Any match of `p` must start with this literal, so a plain `str.find`
+    can reject non-matching lines (or advance the scan start) before the
+    regex engine runs at all.  Returns ("", False) when no literal can be
+    relied on (e.g. top-level alternation).
+    """
+    if len(split_alts(p)) > 1:
+        return "", False
+    anchored = p.startswith("^")
+    out = []
+    i, n = (1, len(p)) if anchored else (0, len(p))
+    while i < n:
+        c = p[i]
+        if c == "\\":
+            if i + 1 >= n or p[i + 1] in "dw" or p[i + 1].isdigit():
+                break
+            c = p[i + 1]
+            step = 2
+        elif c in ".[(|?+^$":
+            break
+        else:
+            step = 1
+        if i + step < n and p[i + step] in "?+":
+            break
+        out.append(c)
+        i += step
+    return "".join(out), anchored
+
+
+@functools.lru_cache(maxsize=256)
+def _pure_literal(p):
+    """(literal, ^-anchored, $-anchored) when `p` is nothing but literal
+    atoms plus optional anchors, else None.  Such patterns need no
+    engine at all: ==, startswith, endswith or `in` decides the line."""
+    astart = p.startswith("^")
+    aend = p.endswith("$") and not p.endswith("\\$")
+    core = p[1 if astart else 0 : len(p) - 1 if aend else len(p)]
+    out = []
+    i, n = 0, len(core)
+    while i < n:
+        c = core[i]
+        if c == "\\":
+            if i + 1 >= n or core[i + 1] in "dw" or core[i + 1].isdigit():
+                return None
+            c = core[i + 1]
+            step = 2
+        elif c in ".[(|?+^$":
+            return None
+        else:
+            step = 1
+        if i + step < n and core[i + step] in "?+":
+            return None
+        out.append(c)
+        i += step
+    return "".join(out), astart, aend
+
+
+@functools.lru_cache(maxsize=256)
+def _literal_suffix(p):
+    """Longest required trailing literal of `p`, plus whether it is $-anchored.
+
+    The mirror of _literal_prefix: any match must contain this literal
+    (end with it, when anchored), so `in`/`str.endswith` can reject a
+    line before the engine runs.  Returns ("", False) when the tail of
+    the pattern is not a plain literal run.
+    """
+    if len(split_alts(p)) > 1:
+        return "", False
+    anchored = p.endswith("$") and not p.endswith("\\$")
+    n = len(p) - 1 if anchored else len(p)
+    out = []
+    i = 1 if p.startswith("^") else 0
+    while i < n:
+        c = p[i]
+        if c == "\\":
+            if i + 1 < n and p[i + 1].isdigit():
+                i += 2
+                while i < n and p[i].isdigit():
+                    i += 1
+                out = []
+                continue
+            if i + 1 >= n or p[i + 1] in "dw":
+                out = []
+                i += 2
+                continue
+            c = p[i + 1]
+            step = 2
+        elif c == "[":
+            j = p.find("]", i + 1)
+            i = j + 1 if j != -1 else n
+            out = []
+            continue
+        elif c == "(":
+            i = find_close(p, i) + 1
+            out = []
+            continue
+        elif c in ".|?+^$":
+            out = []
+            i += 1
+            continue
+        else:
+            step = 1
+        if i + step < n and p[i + step] in "?+":
+            out = []
+            i += step + 1
+            continue
+        out.append(c)
+        i += step
+    return "".join(out), anchored
+
+
+def _line_safe(p):
+    """True if no match of `p` can include a newline, so the raw pattern
+    may scan a whole multi-line buffer and matches mapped back to their
+    containing lines.  Conservative: negated classes match newline."""
+    return "\n" not in p and "[^" not in p
+
+
+def _prefilter(s, p):
+    """Return the position to start searching at, or -1 to reject `s`."""
+    lit, anchored = _literal_prefix(p)
+    if not lit:
+        start = 0
+    elif anchored:
+        if not s.startswith(lit):
+            return -1
+        start = 0
+    else:
+        start = s.find(lit)
+        if start < 0:
+            return -1
+    suf, at_end = _literal_suffix(p)
+    if suf:
+        if at_end:
+            if not s.endswith(suf):
+                return -1
+        elif s.find(suf, start) < 0:
+            return -1
+    return start
+
+
 def find_close(p, i=0):
     depth = 0
     in_class = False
@@ -31,13 +271,15 @@ def find_close(p, i=0):
     raise ValueError("unbalanced ()")
 
 
-def split_alts(p):
+def split_alts_bounds(p, lo, hi):
+    """Top-level alternatives of p[lo:hi] as (start, end) index pairs."""
     out = []
-    start = 0
+    start = lo
     depth = 0
     in_class = False
     esc = False
-    for i, c in enumerate(p):
+    for i in range(lo, hi):
+        c = p[i]
         if esc:
             esc = False
             continue
@@ -58,17 +300,24 @@ def split_alts(p):
             depth -= 1
             continue
         if c == "|" and depth == 0:
-            out.append(p[start:i])
+            out.append((start, i))
             start = i + 1
-    out.append(p[start:])
+    out.append((start, hi))
     return out
 
 
-def count_groups(p):
+def split_alts(p):
+    return [p[a:b] for a, b in split_alts_bounds(p, 0, len(p))]
+
+
+def count_groups(p, lo=0, hi=None):
+    if hi is None:
+        hi = len(p)
     n = 0
     in_class = False
     esc = False
-    for c in p:
+    for i in range(lo, hi):
+        c = p[i]
         if esc:
             esc = False
             continue
@@ -87,152 +336,956 @@ def count_groups(p):
     return n
 
 
-def next_atom(p):
-    if not p:
-        return None, ""
-    if p[0] == ".":
-        return (lambda ch: ch != "\n"), p[1:]
-    if p.startswith("[^]"):
-        return (lambda ch: True), p[3:]
-    if p.startswith("[^"):
-        j = p.index("]")
-        bad = set(p[2:j])
-        return (lambda ch, bad=bad: ch not in bad), p[j + 1 :]
-    if p[0] == "[":
-        j = p.index("]")
-        good = set(p[1:j])
-        return (lambda ch, good=good: ch in good), p[j + 1 :]
-    if p[0] == "\\":
-        if len(p) < 2:
-            return (lambda ch: ch == "\\"), ""
-        t = p[1]
-        if t == "d":
-            return (lambda ch: ch in DIGITS), p[2:]
-        elif t == "w":
-            return (lambda ch: ch in WORD), p[2:]
-        else:
-            return (lambda ch, t=t: ch == t), p[2:]
-    c = p[0]
-    return (lambda ch, c=c: ch == c), p[1:]
+def _class_table(members):
+    """256-byte truth table for a character class (ASCII-range members)."""
+    table = bytearray(256)
+    for ch in members:
+        c = ord(ch)
+        if c < 256:
+            table[c] = 1
+    return bytes(table)
 
 
-def try_backref(s, p, caps):
-    if not p.startswith("\\") or len(p) < 2 or not p[1].isdigit():
+def try_backref(s, si, p, lo, hi, caps):
+    if p[lo] != "\\" or lo + 1 >= hi or not p[lo + 1].isdigit():
         return None
-    j = 2
-    while j < len(p) and p[j].isdigit():
+    j = lo + 2
+    while j < hi and p[j].isdigit():
         j += 1
-    idx = int(p[1:j]) - 1
+    idx = int(p[lo + 1 : j]) - 1
     if idx < 0 or idx >= len(caps) or caps[idx] is None:
         return False
     g = caps[idx]
-    if not s.startswith(g):
+    if not s.startswith(g, si):
         return False
-    return s[len(g) :], p[j:]
+    return si + len(g), j
 
 
-def gen(s, p, caps, gi):
-    if p == "":
-        yield s, caps
-        return
+def _atom_run_end(s, si, n, op):
+    """Largest m such that op accepts every char of s[si:m].
 
-    br = try_backref(s, p, caps)
-    if br is False:
-        return
-    if br is not None:
-        s2, p2 = br
-        yield from gen(s2, p2, caps, gi)
-        return
+    One specialized tight loop per opcode, so the greedy + scan costs a
+    comparison per character instead of a dispatching function call.
+    """
+    code = op[0]
+    m = si
+    if code == CHAR:
+        c = op[1]
+        while m < n and s[m] == c:
+            m += 1
+    elif code == CLASS:
+        table, high = op[1], op[2]
+        while m < n:
+            x = ord(s[m])
+            if not (table[x] if x < 256 else s[m] in high):
+                break
+            m += 1
+    elif code == NCLASS:
+        table, high = op[1], op[2]
+        while m < n:
+            x = ord(s[m])
+            if table[x] if x < 256 else s[m] in high:
+                break
+            m += 1
+    else:  # ANY
+        while m < n and s[m] != "\n":
+            m += 1
+    return m
+
+
+@functools.lru_cache(maxsize=256)
+def _group_info(p):
+    """Per-'(' tables for p, keyed by the opening-paren index: close_of[i]
+    -> matching ')' index, ngroups_in[i] -> number of nested '(' strictly
+    inside the group, and alts_of[i] -> (start, end) bounds of the group
+    body's top-level alternatives.
+
+    Built in one pass so gen() never re-scans the pattern for group or
+    alternation structure while backtracking."""
+    close_of = {}
+    ngroups_in = {}
+    alts_of = {}
+    referenced = set()
+    opens_before = [0] * (len(p) + 1)
+    stack = []
+    in_class = False
+    esc = False
+    for i, c in enumerate(p):
+        opens_before[i + 1] = opens_before[i]
+        if esc:
+            esc = False
+            if not in_class and c.isdigit():
+                j = i + 1
+                while j < len(p) and p[j].isdigit():
+                    j += 1
+                referenced.add(int(p[i:j]) - 1)
+            continue
+        if c == "\\":
+            esc = True
+            continue
+        if in_class:
+            if c == "]":
+                in_class = False
+            continue
+        if c == "[":
+            in_class = True
+            continue
+        if c == "(":
+            stack.append((i, []))
+            opens_before[i + 1] += 1
+            continue
+        if c == "|":
+            if stack:
+                stack[-1][1].append(i)
+            continue
+        if c == ")":
+            if not stack:
+                raise ValueError("unbalanced ()")
+            j, bars = stack.pop()
+            close_of[j] = i
+            starts = [j + 1] + [b + 1 for b in bars]
+            ends = bars + [i]
+            alts_of[j] = tuple(zip(starts, ends))
+    if stack:
+        raise ValueError("unbalanced ()")
+    for j, i in close_of.items():
+        ngroups_in[j] = opens_before[i] - opens_before[j + 1]
+    return close_of, ngroups_in, alts_of, _literal_runs(p), frozenset(referenced)
+
+
+def _literal_runs(p):
+    """start -> (literal string, index past the run) for every maximal
+    run of two or more unquantified literal atoms, so gen() consumes the
+    whole run with one C-level startswith instead of one recursion per
+    character."""
+    runs = {}
+    n = len(p)
+    i = 0
+    start = -1
+    chars = []
+    while i < n:
+        c = p[i]
+        if c in "()|" or (c == "\\" and i + 1 < n and p[i + 1].isdigit()):
+            if len(chars) > 1:
+                runs[start] = ("".join(chars), i)
+            chars = []
+            i += 2 if c == "\\" else 1
+            continue
+        op, j = _vm_atom_at(p, i)
+        if (j < n and p[j] in "?+") or op[0] != CHAR:
+            if len(chars) > 1:
+                runs[start] = ("".join(chars), i)
+            chars = []
+            i = j + 1 if j < n and p[j] in "?+" else j
+            continue
+        if not chars:
+            start = i
+        chars.append(op[1])
+        i = j
+    if len(chars) > 1:
+        runs[start] = ("".join(chars), n)
+    return runs
+
+
+def _gen(s, si, p, lo, hi, caps, gi, failed, info):
+    """Yield (end_index, caps) for each match of p[lo:hi] at s[si:].
+
+    Positions in both the subject and the pattern are threaded as
+    integer indices, and captures are immutable tuples, so forking a
+    branch never copies a string or a list.  Deterministic steps
+    (backrefs, literal runs, unquantified atoms) advance in the loop
+    below; only forking constructs recurse.
+    """
+    n = len(s)
+    while True:
+        if lo >= hi:
+            yield si, caps
+            return
+
+        br = try_backref(s, si, p, lo, hi, caps)
+        if br is False:
+            return
+        if br is not None:
+            si, lo = br
+            continue
 
-    if p[0] == "(":
-        j = find_close(p, 0)
-        body, rest = p[1:j], p[j + 1 :]
-        q = rest[0] if rest else ""
+        run = info[3].get(lo)
+        if run is not None and run[1] <= hi:
+            lit, rend = run
+            if not s.startswith(lit, si):
+                return
+            si += len(lit)
+            lo = rend
+            continue
+
+        if p[lo] == "(":
+            break
+        op, ai = _vm_atom_at(p, lo)
+        if ai < hi and p[ai] in "?+":
+            break
+        if si >= n or not _op_accepts(op, s[si]):
+            return
+        si += 1
+        lo = ai
+
+    if p[lo] == "(":
+        j = info[0][lo]
+        rest_lo = j + 1
+        q = p[rest_lo] if rest_lo < hi else ""
         this_id = gi
         inner_start = gi + 1
-        span = 1 + count_groups(body)
+        span = 1 + info[1][lo]
+        body_alts = info[2][lo]
+        # Only record the capture when some backreference can read it;
+        # otherwise the caps tuple (and the memo keys built from it)
+        # stays untouched.
+        record = this_id in info[4]
 
-        def gen_body(s0, caps0):
-            for alt in split_alts(body):
-                cc = caps0[:] + [None] * max(0, this_id + 1 - len(caps0))
-                for out_s, cc2 in gen(s0, alt, cc, inner_start):
-                    cc3 = cc2[:] + [None] * max(0, this_id + 1 - len(cc2))
-                    cc3[this_id] = s0[: len(s0) - len(out_s)]
-                    yield out_s, cc3
+        def gen_body(si0, caps0):
+            # caps is pre-sized to the full group count, so recording a
+            # capture is a single tuple rebuild, never a pad + copy.
+            for a, b in body_alts:
+                for out_si, cc2 in gen(s, si0, p, a, b, caps0, inner_start, failed, info):
+                    if record:
+                        yield out_si, cc2[:this_id] + (s[si0:out_si],) + cc2[this_id + 1 :]
+                    else:
+                        yield out_si, cc2
 
         if q == "+":
-            rest2 = rest[1:]
-            stack = list(gen_body(s, caps))
+            # Stack of (base, iterator) so expansions stream lazily
+            # instead of materializing every body match up front.
+            rest2 = rest_lo + 1
+            stack = [(si, gen_body(si, caps))]
             while stack:
-                out_s, ccx = stack.pop()
-                yield from gen(out_s, rest2, ccx, gi + span)
-                if len(out_s) < len(s):
-                    for out2, cc2 in gen_body(out_s, ccx):
-                        if len(out2) != len(out_s):
-                            stack.append((out2, cc2))
+                base, it = stack[-1]
+                nxt = next(it, None)
+                if nxt is None:
+                    stack.pop()
+                    continue
+                out_si, ccx = nxt
+                if out_si == base and base != si:
+                    continue  # zero-width repeat; never expanded before either
+                yield from gen(s, out_si, p, rest2, hi, ccx, gi + span, failed, info)
+                if out_si > si:
+                    stack.append((out_si, gen_body(out_si, ccx)))
             return
 
         if q == "?":
-            rest2 = rest[1:]
-            for out_s, ccx in gen_body(s, caps):
-                yield from gen(out_s, rest2, ccx, gi + span)
-            yield from gen(s, rest2, caps[:], gi + span)
+            rest2 = rest_lo + 1
+            for out_si, ccx in gen_body(si, caps):
+                yield from gen(s, out_si, p, rest2, hi, ccx, gi + span, failed, info)
+            yield from gen(s, si, p, rest2, hi, caps, gi + span, failed, info)
             return
 
-        for out_s, ccx in gen_body(s, caps):
-            yield from gen(out_s, rest, ccx, gi + span)
+        for out_si, ccx in gen_body(si, caps):
+            yield from gen(s, out_si, p, rest_lo, hi, ccx, gi + span, failed, info)
         return
 
-    f, rest = next_atom(p)
-    if f is None:
-        return
-    q = rest[0] if rest else ""
+    op, ai = _vm_atom_at(p, lo)
+    q = p[ai] if ai < hi else ""
 
     if q == "+":
-        tail = rest[1:]
-        if not s or not f(s[0]):
+        tail = ai + 1
+        m = _atom_run_end(s, si, n, op)
+        if m == si:
             return
-        i = 1
-        while i <= len(s) and f(s[i - 1]):
-            i += 1
-        i -= 1
-        for k in range(i, 0, -1):
-            yield from gen(s[k:], tail, caps[:], gi)
+        # ".+lit" fast path: every viable split puts `lit` right after
+        # the dot run, so jump between occurrences with str.rfind
+        # (rightmost first, preserving greedy order) instead of counting
+        # the run length down one position at a time.
+        if op[0] == ANY and tail < hi:
+            lit = None
+            nxt_run = info[3].get(tail)
+            if nxt_run is not None and nxt_run[1] <= hi:
+                lit, rend = nxt_run
+            elif p[tail] not in ".[(\\":
+                nop, nai = _vm_atom_at(p, tail)
+                if nai >= hi or p[nai] not in "?+":
+                    lit, rend = nop[1], nai
+            if lit is not None:
+                h = s.rfind(lit, si + 1, m + len(lit))
+                while h != -1:
+                    yield from gen(s, h + len(lit), p, rend, hi, caps, gi, failed, info)
+                    h = s.rfind(lit, si + 1, h + len(lit) - 1)
+                return
+        # Possessive fast path: when the next atom is mandatory and can
+        # never accept a character this atom accepts, no shorter run can
+        # succeed, so skip the backtracking enumeration entirely.
+        if tail < hi and p[tail] != "(" and not (
+            p[tail] == "\\" and tail + 1 < hi and p[tail + 1].isdigit()
+        ):
+            nop, nai = _vm_atom_at(p, tail)
+            if nai <= hi and (nai >= hi or p[nai] != "?") and _ops_disjoint(op, nop):
+                yield from gen(s, m, p, tail, hi, caps, gi, failed, info)
+                return
+        for k in range(m, si, -1):
+            yield from gen(s, k, p, tail, hi, caps, gi, failed, info)
         return
 
-    if q == "?":
-        tail = rest[1:]
-        if s and f(s[0]):
-            yield from gen(s[1:], tail, caps[:], gi)
-        yield from gen(s, tail, caps[:], gi)
+    # The loop above consumed every unquantified atom, so q is ? here.
+    tail = ai + 1
+    if si < n and _op_accepts(op, s[si]):
+        yield from gen(s, si + 1, p, tail, hi, caps, gi, failed, info)
+    yield from gen(s, si, p, tail, hi, caps, gi, failed, info)
+
+
+# Pike-VM opcodes: the pattern is compiled once into a flat program and
+# simulated breadth-first, so backref-free matching is O(|s|*|prog|)
+# instead of exponential in the backtracking generator.  CLASS/NCLASS
+# carry a 256-byte truth table plus a (usually empty) frozenset for
+# members outside the table's range.
+CHAR, CLASS, NCLASS, ANY, FORK, JMP, SAVE, MATCH = range(8)
+
+_DIGIT_TABLE = _class_table(DIGITS)
+_WORD_TABLE = _class_table(WORD)
+_EMPTY = frozenset()
+_MATCH_ALL = (NCLASS, _class_table(""), _EMPTY)  # [^] : any char at all
+
+
+def _has_backref(p):
+    in_class = False
+    esc = False
+    for i, c in enumerate(p):
+        if esc:
+            esc = False
+            if not in_class and c.isdigit():
+                return True
+            continue
+        if c == "\\":
+            esc = True
+            continue
+        if in_class:
+            if c == "]":
+                in_class = False
+        elif c == "[":
+            in_class = True
+    return False
+
+
+def _expand_class(members):
+    """Expand a-z ranges; a '-' that cannot form a range stays literal."""
+    out = set()
+    i, n = 0, len(members)
+    while i < n:
+        if i + 2 < n and members[i + 1] == "-" and ord(members[i]) <= ord(members[i + 2]):
+            out.update(map(chr, range(ord(members[i]), ord(members[i + 2]) + 1)))
+            i += 3
+        else:
+            out.add(members[i])
+            i += 1
+    return out
+
+
+_class_cache = {}
+
+
+def _class_op(code, members):
+    """Build (or reuse) a class opcode, keyed by the class source text,
+    so backtracking over the same atom never rebuilds its table."""
+    key = (code, members)
+    op = _class_cache.get(key)
+    if op is None:
+        chars = _expand_class(members)
+        high = frozenset(ch for ch in chars if ord(ch) >= 256)
+        op = _class_cache[key] = (code, _class_table(chars), high)
+    return op
+
+
+def _vm_atom_at(p, i):
+    """Parse the atom starting at p[i]; returns (op, index past the atom)."""
+    c = p[i]
+    if c == ".":
+        return (ANY,), i + 1
+    if p.startswith("[^]", i):
+        return _MATCH_ALL, i + 3
+    if p.startswith("[^", i):
+        j = p.index("]", i + 2)
+        return _class_op(NCLASS, p[i + 2 : j]), j + 1
+    if c == "[":
+        j = p.index("]", i + 1)
+        return _class_op(CLASS, p[i + 1 : j]), j + 1
+    if c == "\\":
+        if i + 1 >= len(p):
+            return (CHAR, "\\"), i + 1
+        t = p[i + 1]
+        if t == "d":
+            return (CLASS, _DIGIT_TABLE, _EMPTY), i + 2
+        if t == "w":
+            return (CLASS, _WORD_TABLE, _EMPTY), i + 2
+        return (CHAR, t), i + 2
+    return (CHAR, c), i + 1
+
+
+def _vm_emit(p, lo, hi, prog, gctr):
+    """Emit code for p[lo:hi] including top-level alternation."""
+    alts = split_alts_bounds(p, lo, hi)
+    if len(alts) == 1:
+        _vm_emit_seq(p, lo, hi, prog, gctr)
         return
+    jmps = []
+    for a, b in alts[:-1]:
+        f = len(prog)
+        prog.append(None)
+        _vm_emit_seq(p, a, b, prog, gctr)
+        jmps.append(len(prog))
+        prog.append(None)
+        prog[f] = (FORK, f + 1, len(prog))
+    a, b = alts[-1]
+    _vm_emit_seq(p, a, b, prog, gctr)
+    end = len(prog)
+    for j in jmps:
+        prog[j] = (JMP, end)
 
-    if not s or not f(s[0]):
+
+def _vm_emit_seq(p, lo, hi, prog, gctr):
+    while lo < hi:
+        if p[lo] == "(":
+            j = find_close(p, lo)
+            body_lo, body_hi = lo + 1, j
+            lo = j + 1
+            q = p[lo] if lo < hi else ""
+            gi = gctr[0]
+            gctr[0] += 1
+            if q == "?":
+                lo += 1
+                f = len(prog)
+                prog.append(None)
+                prog.append((SAVE, 2 * gi))
+                _vm_emit(p, body_lo, body_hi, prog, gctr)
+                prog.append((SAVE, 2 * gi + 1))
+                prog[f] = (FORK, f + 1, len(prog))
+            elif q == "+":
+                lo += 1
+                start = len(prog)
+                prog.append((SAVE, 2 * gi))
+                _vm_emit(p, body_lo, body_hi, prog, gctr)
+                prog.append((SAVE, 2 * gi + 1))
+                f = len(prog)
+                prog.append((FORK, start, f + 1))
+            else:
+                prog.append((SAVE, 2 * gi))
+                _vm_emit(p, body_lo, body_hi, prog, gctr)
+                prog.append((SAVE, 2 * gi + 1))
+            continue
+        op, lo = _vm_atom_at(p, lo)
+        q = p[lo] if lo < hi else ""
+        if q == "?":
+            lo += 1
+            f = len(prog)
+            prog.append(None)
+            prog.append(op)
+            prog[f] = (FORK, f + 1, len(prog))
+        elif q == "+":
+            lo += 1
+            start = len(prog)
+            prog.append(op)
+            f = len(prog)
+            prog.append((FORK, start, f + 1))
+        else:
+            prog.append(op)
+
+
+@functools.lru_cache(maxsize=256)
+def _vm_program(core):
+    """Compile to SoA form: a compact opcode byte-string plus parallel
+    operand tuples, indexed by pc."""
+    ops = []
+    _vm_emit(core, 0, len(core), ops, [0])
+    ops.append((MATCH,))
+    codes = bytes(op[0] for op in ops)
+    arg1 = tuple(op[1] if len(op) > 1 else None for op in ops)
+    arg2 = tuple(op[2] if len(op) > 2 else None for op in ops)
+    return codes, arg1, arg2
+
+
+def _vm_add(prog, threads, pc):
+    """Follow epsilon transitions (FORK/JMP/SAVE) from pc into `threads`.
+
+    Iterative with an explicit work stack: a long FORK/JMP chain (one
+    per quantifier or alternative) must not consume Python stack frames.
+    """
+    codes, arg1, arg2 = prog
+    work = [pc]
+    while work:
+        pc = work.pop()
+        while pc not in threads:
+            threads.add(pc)
+            code = codes[pc]
+            if code == JMP:
+                pc = arg1[pc]
+            elif code == FORK:
+                work.append(arg2[pc])
+                pc = arg1[pc]
+            elif code == SAVE:
+                pc += 1
+            else:
+                break
+
+
+def gen(s, si, p, lo, hi, caps, gi, failed, info):
+    """Memoizing front for _gen: a configuration that once produced no
+    match is recorded in `failed` (fresh per top-level match) and never
+    re-explored, bounding backtracking at O(configurations)."""
+    # hi is a function of lo for a fixed pattern (each position has one
+    # enclosing region), so the key stays minimal: cheap to build & hash.
+    key = (si, lo, caps)
+    if key in failed:
         return
-    yield from gen(s[1:], rest, caps, gi)
+    hit = False
+    for out in _gen(s, si, p, lo, hi, caps, gi, failed, info):
+        hit = True
+        yield out
+    if not hit:
+        failed.add(key)
 
 
-def matches(s, p):
-    alts = split_alts(p)
-    if len(alts) > 1:
-        return any(matches(s, a) for a in alts)
-    if p.startswith("^") and p.endswith("$"):
-        return any(out == "" for out, _ in gen(s, p[1:-1], [], 0))
-    if p.endswith("$"):
-        core = p[:-1]
-        for i in range(len(s) + 1):
-            if any(out == "" for out, _ in gen(s[i:], core, [], 0)):
+def _op_accepts(op, ch):
+    code = op[0]
+    if code == CHAR:
+        return ch == op[1]
+    if code == CLASS:
+        c = ord(ch)
+        return bool(op[1][c]) if c < 256 else ch in op[2]
+    if code == NCLASS:
+        c = ord(ch)
+        return not op[1][c] if c < 256 else ch not in op[2]
+    if code == ANY:
+        return ch != "\n"
+    return False
+
+
+@functools.lru_cache(maxsize=512)
+def _ops_disjoint(a, b):
+    """True if no character is accepted by both atoms.
+
+    Conservative (False when unsure); ANY overlaps everything and two
+    negated classes always share most of the alphabet."""
+    ca, cb = a[0], b[0]
+    if ca == ANY or cb == ANY:
+        return False
+    if ca == CHAR and cb == CHAR:
+        return a[1] != b[1]
+    if cb == CHAR:
+        a, b = b, a
+        ca, cb = cb, ca
+    if ca == CHAR:
+        x = ord(a[1])
+        hit = bool(b[1][x]) if x < 256 else a[1] in b[2]
+        return not hit if cb == CLASS else hit
+    if ca == NCLASS and cb == NCLASS:
+        return False
+    if ca == NCLASS:
+        a, b = b, a
+        ca, cb = cb, ca
+    ta, tb = a[1], b[1]
+    if cb == CLASS:
+        return not any(ta[i] and tb[i] for i in range(256)) and not (a[2] & b[2])
+    # CLASS vs NCLASS: every char the class accepts must be one the
+    # negated class excludes.
+    return all(tb[i] for i in range(256) if ta[i]) and a[2] <= b[2]
+
+
+class _LazyDFA:
+    """On-the-fly subset construction over a Pike VM program.
+
+    Each DFA state is an int bitmask of VM pcs (one bit per pc, so any
+    program size fits); transitions are filled in lazily as input is
+    consumed and cached in a bounded table (cleared wholesale when it
+    overflows, like rust-regex's bounded DFA cache).  Input characters
+    are first mapped through a 128-entry equivalence ("color") table so
+    distinct chars with identical behaviour share transitions.
+    """
+
+    MAX_STATES = 4096
+
+    def __init__(self, prog, anchored_start):
+        self.prog = prog
+        self.anchored_start = anchored_start
+        codes, arg1, arg2 = prog
+        self.codes = codes
+        self.ops = tuple((codes[pc], arg1[pc], arg2[pc]) for pc in range(len(codes)))
+        self.consuming = [
+            pc for pc in range(len(codes)) if codes[pc] in (CHAR, CLASS, NCLASS, ANY)
+        ]
+        self._build_colors()
+        # Epsilon closure of each pc as a bitmask, so stepping is pure
+        # integer ORs with no per-step set building.
+        masks = []
+        for pc in range(len(codes)):
+            t = set()
+            _vm_add(prog, t, pc)
+            masks.append(sum(1 << q for q in t))
+        self.closure_masks = masks
+        self.accept_mask = sum(1 << pc for pc in range(len(codes)) if codes[pc] == MATCH)
+        self.start = masks[0]
+        self._reset_cache()
+
+    def _build_colors(self):
+        ops = self.ops
+        sig_to_color = {}
+        self.colors = []
+        for code in range(128):
+            ch = chr(code)
+            sig = tuple(_op_accepts(ops[pc], ch) for pc in self.consuming)
+            color = sig_to_color.setdefault(sig, len(sig_to_color))
+            self.colors.append(color)
+        self._sig_to_color = sig_to_color
+        self._wide = {}  # color lookups for non-ASCII chars
+
+    def _color(self, ch):
+        code = ord(ch)
+        if code < 128:
+            return self.colors[code]
+        color = self._wide.get(ch)
+        if color is None:
+            sig = tuple(_op_accepts(self.ops[pc], ch) for pc in self.consuming)
+            color = self._sig_to_color.setdefault(sig, len(self._sig_to_color))
+            self._wide[ch] = color
+        return color
+
+    def _reset_cache(self):
+        self.trans = {self.start: {}}
+
+    def _step(self, state, ch):
+        ops = self.ops
+        masks = self.closure_masks
+        nxt = 0
+        m = state
+        while m:
+            b = m & -m
+            m ^= b
+            pc = b.bit_length() - 1
+            if _op_accepts(ops[pc], ch):
+                nxt |= masks[pc + 1]
+        if not self.anchored_start:
+            nxt |= self.start
+        return nxt
+
+    def run(self, s, anchored_end):
+        state = self.start
+        accept = self.accept_mask
+        if not anchored_end and state & accept:
+            return True
+        trans = self.trans
+        for ch in s:
+            row = trans.get(state)
+            if row is None:
+                if len(trans) >= self.MAX_STATES:
+                    self._reset_cache()
+                    trans = self.trans
+                row = trans[state] = {}
+            color = self._color(ch)
+            nstate = row.get(color)
+            if nstate is None:
+                nstate = row[color] = self._step(state, ch)
+            state = nstate
+            if not state and self.anchored_start:
+                return False
+            if not anchored_end and state & accept:
                 return True
+        return bool(state & accept)
+
+
+@functools.lru_cache(maxsize=64)
+def _lazy_dfa(core, anchored_start):
+    return _LazyDFA(_vm_program(core), anchored_start)
+
+
+def matches(s, p):
+    pure = _pure_literal(p)
+    if pure is not None:
+        lit, astart, aend = pure
+        if astart and aend:
+            return s == lit
+        if astart:
+            return s.startswith(lit)
+        if aend:
+            return s.endswith(lit)
+        return lit in s
+    try:
+        pat = _compile(p)
+    except (re.error, ValueError):
+        return _matches_fallback(s, p)
+    start = _prefilter(s, p)
+    if start < 0:
         return False
-    if p.startswith("^"):
-        return any(True for _ in gen(s, p[1:], [], 0))
-    for i in range(len(s) + 1):
-        if any(True for _ in gen(s[i:], p, [], 0)):
+    return pat.search(s, start) is not None
+
+
+@functools.lru_cache(maxsize=256)
+def _fallback_plan(p):
+    """Per-alternative analysis for the fallback engine, computed once.
+
+    Each entry is (core, anchored_end, dfa, info, caps0): `dfa` drives
+    backref-free alternatives, otherwise the group tables and pre-sized
+    capture tuple feed the backtracking generator."""
+    plans = []
+    dfa_cores = {}  # (astart, aend) -> [core, ...], merged into one DFA
+    for a in split_alts(p):
+        astart = a.startswith("^")
+        aend = a.endswith("$")
+        core = a[1 if astart else 0 : len(a) - 1 if aend else len(a)]
+        if _has_backref(core):
+            plans.append(
+                (core, astart, aend, None, _group_info(core), (None,) * count_groups(core))
+            )
+        else:
+            dfa_cores.setdefault((astart, aend), []).append(core)
+    # Backref-free alternatives with the same anchors share one program
+    # (the VM emitter handles top-level |), so the subject is scanned
+    # once per anchor shape instead of once per alternative.
+    for (astart, aend), cores in dfa_cores.items():
+        core = "|".join(cores)
+        plans.append((core, astart, aend, _lazy_dfa(core, astart), None, None))
+    return tuple(plans)
+
+
+def _backref_search(s, core, astart, aend, info, caps0):
+    """One search loop for all four anchor combinations.
+
+    ^ restricts the start positions, $ restricts which ends count; the
+    failure memo is shared across start positions (keys include si).
+    The VM/DFA side gets the same effect from start-state injection and
+    its anchored_end flag, so only the backref engine needs this loop.
+    """
+    n = len(s)
+    clen = len(core)
+    failed = set()
+    lit, _ = _literal_prefix(core)
+    if astart and lit and not s.startswith(lit):
+        return False
+    if lit and not astart:
+        # Every match starts with `lit`, so str.find enumerates the only
+        # candidate start positions at C speed.
+        i = s.find(lit)
+        while i >= 0:
+            for out, _ in gen(s, i, core, 0, clen, caps0, 0, failed, info):
+                if not aend or out == n:
+                    return True
+            i = s.find(lit, i + 1)
+        return False
+    # No usable literal: filter start positions on the first atom when
+    # it is mandatory, so most positions fail on one table lookup
+    # instead of a generator call.
+    first_op = None
+    if clen and core[0] != "(" and not (core[0] == "\\" and clen > 1 and core[1].isdigit()):
+        op0, a0 = _vm_atom_at(core, 0)
+        if a0 <= clen and (a0 >= clen or core[a0] != "?"):
+            first_op = op0
+    for i in (0,) if astart else range(n + 1):
+        if first_op is not None and (i >= n or not _op_accepts(first_op, s[i])):
+            continue
+        for out, _ in gen(s, i, core, 0, clen, caps0, 0, failed, info):
+            if not aend or out == n:
+                return True
+    return False
+
+
+def _matches_fallback(s, p):
+    for core, astart, aend, dfa, info, caps0 in _fallback_plan(p):
+        if dfa is not None:
+            if dfa.run(s, aend):
+                return True
+        elif _backref_search(s, core, astart, aend, info, caps0):
             return True
     return False
 
+class CompiledPattern:
+    """Per-invocation compiled form of the CLI pattern.
+
+    `pat` matches anywhere in a single line; `line_pat` is an anchored
+    whole-line variant used to scan an entire file buffer in one C-level
+    pass instead of a Python per-line loop.  Both are None when the
+    pattern only compiles with the fallback engine.
+    """
+
+    __slots__ = (
+        "pattern",
+        "pure",
+        "pat",
+        "line_pat",
+        "raw_bytes",
+        "lit_bytes",
+    )
+
+    def __init__(self, pattern):
+        self.pattern = pattern
+        self.pure = _pure_literal(pattern)
+        self.line_pat = None
+        self.raw_bytes = None
+        self.lit_bytes = None
+        try:
+            translated = _translate(pattern)
+            # Single lines get the \Z form: the dialect's $ is end of
+            # string, not re's "or before a trailing newline".
+            self.pat = re.compile(_translate(pattern, r"\Z"))
+            if _line_safe(pattern):
+                # Whole-buffer scanning is only sound when no match can
+                # cross a newline; a negated class would let one "line
+                # match" swallow several physical lines.
+                line_src = r"^[^\n]*(?:" + translated + r")[^\n]*$"
+                self.line_pat = re.compile(line_src, re.MULTILINE)
+                if translated.isascii():
+                    # ASCII patterns can scan raw bytes, skipping the UTF-8
+                    # decode of every non-matching line entirely: the bare
+                    # pattern over the buffer lets re use its literal
+                    # prefilter, and containing lines come from match offsets.
+                    self.raw_bytes = re.compile(translated.encode(), re.MULTILINE)
+                    lit, _ = _literal_prefix(pattern)
+                    if lit.isascii():
+                        self.lit_bytes = lit.encode()
+        except (re.error, ValueError):
+            self.pat = None
+            self.line_pat = None
+
+    def match_line(self, line):
+        if self.pure is not None:
+            lit, astart, aend = self.pure
+            if astart and aend:
+                return line == lit
+            if astart:
+                return line.startswith(lit)
+            if aend:
+                return line.endswith(lit)
+            return lit in line
+        if self.pat is not None:
+            start = _prefilter(line, self.pattern)
+            if start < 0:
+                return False
+            return self.pat.search(line, start) is not None
+        return _matches_fallback(line, self.pattern)
+
+
+def compile_matcher(pattern):
+    """Compile once per invocation."""
+    return CompiledPattern(pattern)
+
+
+# One C-level scan decides whether a buffer may be matched byte-wise:
+# non-ASCII bytes break the byte/char offset equivalence (mmap has no
+# isascii(); re searches it without copying), and '\r' needs the text
+# path's universal-newline translation.
+_NEEDS_TEXT = re.compile(rb"[\r\x80-\xff]")
+
+
+def _search_file(path, cp, display_name=None):
+    """Collect matching lines of one file; no output, so it is safe to
+    run from worker threads."""
+    hits = []
+    try:
+        if cp.raw_bytes is not None:
+            with open(path, "rb") as f:
+                try:
+                    mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                except ValueError:  # empty file: no lines
+                    return hits
+                bytes_ok = True
+                with mm:
+                    if _NEEDS_TEXT.search(mm):
+                        # Non-ASCII data ('.', counting, classes) or
+                        # CRLF line endings: fall through to the text
+                        # path, which reads char-wise and strips '\r'.
+                        bytes_ok = False
+                    elif cp.lit_bytes and mm.find(cp.lit_bytes) < 0:
+                        return hits
+                    else:
+                        end = len(mm)
+                        if mm[end - 1 : end] == b"\n":
+                            end -= 1
+                        last_end = -1
+                        for m in cp.raw_bytes.finditer(mm, 0, end):
+                            if m.start() <= last_end and last_end >= 0:
+                                continue  # same line as the previous hit
+                            ls = mm.rfind(b"\n", 0, m.start()) + 1
+                            le = mm.find(b"\n", m.end(), end)
+                            if le < 0:
+                                le = end
+                            line = mm[ls:le].decode("ascii")
+                            hits.append(
+                                f"{display_name}:{line}" if display_name else line
+                            )
+                            last_end = le
+                if bytes_ok:
+                    return hits
+        with open(path, "r", encoding="utf-8", errors="ignore") as f:
+            if cp.line_pat is not None:
+                data = f.read()
+                if data.endswith("\n"):
+                    data = data[:-1]
+                lit, _ = _literal_prefix(cp.pattern)
+                if lit and lit not in data:
+                    return hits
+                for m in cp.line_pat.finditer(data):
+                    line = m.group(0)
+                    hits.append(f"{display_name}:{line}" if display_name else line)
+            else:
+                for line in f:
+                    line = line.rstrip("\n")
+                    if cp.match_line(line):
+                        hits.append(f"{display_name}:{line}" if display_name else line)
+    except Exception:
+        pass
+    return hits
+
+
+def _emit(hits):
+    if hits:
+        # One stdout write per file instead of one print per match.
+        sys.stdout.write("\n".join(hits) + "\n")
+    return bool(hits)
+
+
+def grep_in_file(path, cp, display_name=None):
+    return _emit(_search_file(path, cp, display_name))
+
+
+def grep_files_parallel(paths, cp, prefix_names):
+    """Search many files concurrently; output stays in `paths` order.
+
+    File I/O and large re scans release the GIL, so threads give real
+    overlap here without process overhead.
+    """
+    matched = False
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as ex:
+        futs = [
+            ex.submit(_search_file, path, cp, path if prefix_names else None)
+            for path in paths
+        ]
+        for fut in futs:
+            if _emit(fut.result()):
+                matched = True
+    return matched
+
+
+def _walk(d):
+    """Lazily yield file paths under d, using scandir's cached stat info."""
+    try:
+        with os.scandir(d) as it:
+            for e in it:
+                if e.is_dir(follow_symlinks=False):
+                    yield from _walk(e.path)
+                elif e.is_file(follow_symlinks=False):
+                    yield e.path
+    except OSError:
+        pass
+
+
+def grep_in_directory(path, match):
+    return grep_files_parallel(_walk(path), match, prefix_names=True)
+
 
 def main():
+    # gen() and the VM emitter recurse over pattern structure, so deeply
+    # nested groups (or long tails behind many atoms) can outrun the
+    # default 1000-frame limit on legitimate patterns.
+    sys.setrecursionlimit(20000)
+
+    # Block-buffer stdout even when piped; we flush implicitly at exit.
+    try:
+        sys.stdout.reconfigure(line_buffering=False, write_through=False)
+    except (AttributeError, ValueError):
+        pass
+
     args = sys.argv[1:]
 
     if not args or "-E" not in args:
@@ -257,40 +1310,30 @@ def main():
     pattern = args[e_index + 1]
     files = args[e_index + 2:]
 
+    # Pay the compile cost once per invocation, not once per line.
+    match = compile_matcher(pattern)
+
     matched = False
 
     # stdin mode
     if not files:
         text = sys.stdin.read()
-        if matches(text, pattern):
+        if match.match_line(text):
             matched = True
         sys.exit(0 if matched else 1)
 
-    for path in files:
-        if recursive and os.path.isdir(path):
-            for root, _, filenames in os.walk(path):
-                for fname in filenames:
-                    fpath = os.path.join(root, fname)
-                    try:
-                        with open(fpath, "r", encoding="utf-8", errors="ignore") as f:
-                            for line in f:
-                                line = line.rstrip("\n")
-                                if matches(line, pattern):
-                                    print(f"{fpath}:{line}")
-                                    matched = True
-                    except Exception:
-                        continue
-        else:
-            try:
-                with open(path, "r", encoding="utf-8", errors="ignore") as f:
-                    for line in f:
-                        line = line.rstrip("\n")
-                        if matches(line, pattern):
-                            prefix = f"{path}:" if len(files) > 1 or recursive else ""
-                            print(f"{prefix}{line}")
-                            matched = True
-            except Exception:
-                continue
+    prefix_names = len(files) > 1 or recursive
+    if not recursive and len(files) > 1:
+        matched = grep_files_parallel(files, match, prefix_names=True)
+    else:
+        for path in files:
+            if recursive and os.path.isdir(path):
+                if grep_in_directory(path, match):
+                    matched = True
+            else:
+                display = path if prefix_names else None
+                if grep_in_file(path, match, display_name=display):
+                    matched = True
 
     sys.exit(0 if matched else 1)
 